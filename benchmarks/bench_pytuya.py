@@ -0,0 +1,311 @@
+"""Micro-benchmarks for the pytuya protocol hot paths.
+
+Run from the repository root:
+    python -m benchmarks.bench_pytuya
+"""
+
+import asyncio
+import socket
+import struct
+import time
+import timeit
+import tracemalloc
+
+from custom_components.localtuya.core.pytuya import (
+    AESCipher,
+    CONTROL,
+    DP_QUERY,
+    EmptyListener,
+    HEART_BEAT,
+    MessageDispatcher,
+    MessagePayload,
+    PREFIX_55AA_BIN,
+    PREFIX_55AA_VALUE,
+    PREFIX_6699_BIN,
+    PREFIX_6699_VALUE,
+    MESSAGE_RECV_HEADER_FMT,
+    PROTOCOL_3x_HEADER,
+    STATUS,
+    TuyaMessage,
+    TuyaProtocol,
+    pack_message,
+    parse_header,
+    unpack_message,
+)
+
+DEV_ID = "767823809c9c1f458745"
+LOCAL_KEY = b"wV[NcWGUSFF`dSgO"
+VERSIONS = (3.3, 3.4, 3.5)
+# A sub-device status push as relayed by a gateway, roughly 300 bytes.
+PAYLOAD = (
+    b'{"dps":{"1":true,"2":false,"3":"auto","18":1234,"19":5678,"20":2301,'
+    b'"101":"AAAAAAAAAAAAAAAAAAAAAA==","102":"BBBBBBBBBBBBBBBBBBBBBB==",'
+    b'"103":"CCCCCCCCCCCCCCCCCCCCCC==","104":49,"105":51,"106":"cold"},'
+    b'"cid":"a4c1388f9b7e25ff","t":1700000000}'
+)
+
+
+def make_frame(version, seqno, payload=PAYLOAD, key=LOCAL_KEY):
+    """Return a device -> client STATUS frame for the protocol version."""
+    if version >= 3.5:
+        msg = TuyaMessage(seqno, STATUS, 0, payload, 0, True, PREFIX_6699_VALUE, True)
+        return pack_message(msg, hmac_key=key)
+
+    payload = struct.pack(">I", 0) + payload
+    msg = TuyaMessage(seqno, STATUS, 0, payload, 0, True, PREFIX_55AA_VALUE, None)
+    return pack_message(msg, hmac_key=key if version >= 3.4 else None)
+
+
+class LegacyDispatcher(MessageDispatcher):
+    """The previous bytes based reassembly, kept as the baseline."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.buffer = b""
+
+    def add_data(self, data):
+        self.buffer += data
+
+        header_len = struct.calcsize(MESSAGE_RECV_HEADER_FMT)
+        while self.buffer:
+            if len(self.buffer) < header_len:
+                break
+
+            prefix_offset_55AA = self.buffer.find(PREFIX_55AA_BIN)
+            prefix_offset_6699 = self.buffer.find(PREFIX_6699_BIN)
+            prefixes = (prefix_offset_55AA, prefix_offset_6699)
+
+            if prefix_offset_55AA < 0 and prefix_offset_6699 < 0:
+                self.buffer = b""
+                break
+
+            if prefix_offset_55AA != 0 and prefix_offset_6699 != 0:
+                prefix_offset = min(prefix for prefix in prefixes if not prefix < 0)
+                self.buffer = self.buffer[prefix_offset:]
+
+            header = parse_header(self.buffer, logger=self)
+            if len(self.buffer) < header.total_length:
+                break
+
+            hmac_key = self.local_key if self.version >= 3.4 else None
+            msg = unpack_message(
+                self.buffer, header=header, hmac_key=hmac_key, logger=self
+            )
+            self.buffer = self.buffer[header.total_length :]
+            self._dispatch(msg)
+
+
+def _dispatcher(cls, version):
+    dispatcher = cls(DEV_ID, lambda msg, ack=False: None, version, LOCAL_KEY)
+    dispatcher.set_logger(_null_logger(), DEV_ID)
+    return dispatcher
+
+
+def _null_logger():
+    import logging
+
+    logger = logging.getLogger("bench_pytuya")
+    logger.disabled = True
+    return logger
+
+
+def _chunks(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def bench_reassembly(number=200):
+    """Feed coalesced and fragmented streams to the dispatcher."""
+    print("MessageDispatcher.add_data (frames/s, higher is better)")
+    print(f"{'stream':<30}{'legacy':>12}{'current':>12}{'gain':>8}")
+    for version in VERSIONS:
+        for frames_per_read in (1, 8, 32, 64):
+            stream = b"".join(
+                make_frame(version, seqno) for seqno in range(frames_per_read)
+            )
+            for label, reads in (
+                (f"{frames_per_read} coalesced", [stream]),
+                (f"{frames_per_read} in 1460B reads", _chunks(stream, 1460)),
+                (f"{frames_per_read} in 64B chunks", _chunks(stream, 64)),
+            ):
+                rates = []
+                for cls in (LegacyDispatcher, MessageDispatcher):
+                    dispatcher = _dispatcher(cls, version)
+
+                    def run():
+                        for data in reads:
+                            dispatcher.add_data(data)
+
+                    elapsed = min(timeit.repeat(run, number=number, repeat=5))
+                    rates.append(frames_per_read * number / elapsed)
+                print(
+                    f"v{version} {label:<25}{rates[0]:>12.0f}{rates[1]:>12.0f}"
+                    f"{rates[1] / rates[0]:>7.2f}x"
+                )
+
+
+def make_encrypted_frame(version, seqno, payload=PAYLOAD, key=LOCAL_KEY):
+    """Return a STATUS frame with the payload encrypted like a device does."""
+    header = str(version).encode() + PROTOCOL_3x_HEADER
+    if version == 3.4:
+        payload = AESCipher(key).encrypt(header + payload, False)
+    elif version < 3.4:
+        payload = header + AESCipher(key).encrypt(payload, False)
+    else:
+        payload = header + payload
+    return make_frame(version, seqno, payload, key)
+
+
+def _protocol(version):
+    async def _create():
+        return TuyaProtocol(DEV_ID, LOCAL_KEY.decode(), version, False, LISTENER)
+
+    return asyncio.run(_create())
+
+
+class BenchListener(EmptyListener):
+    """Listener that drops every update."""
+
+    sub_devices = {}
+
+
+LISTENER = BenchListener()
+
+
+def bench_crypto(number=2000):
+    """Encode CONTROL frames and receive encrypted STATUS frames."""
+    print("TuyaProtocol encode / receive (ops/s, higher is better)")
+    print(f"{'version':<10}{'encode':>12}{'receive':>12}")
+    control = MessagePayload(CONTROL, b'{"dps":{"1":true,"2":50}}')
+    for version in VERSIONS:
+        protocol = _protocol(version)
+        frame = make_encrypted_frame(version, 1)
+
+        encode = min(
+            timeit.repeat(
+                lambda: protocol._encode_message(control), number=number, repeat=5
+            )
+        )
+        receive = min(
+            timeit.repeat(
+                lambda: protocol.data_received(frame), number=number, repeat=5
+            )
+        )
+        print(f"v{version:<9}{number / encode:>12.0f}{number / receive:>12.0f}")
+
+
+def bench_payload(number=20000):
+    """Generate heartbeat, status and multi-DP control payloads."""
+    print("TuyaProtocol._generate_payload (us/call, lower is better)")
+    print(f"{'version':<10}{'heartbeat':>12}{'status':>12}{'control':>12}")
+    dps = {"1": True, "2": "white", "3": 255, "4": 500, "5": "scene 1", "6": False}
+    for version in VERSIONS:
+        protocol = _protocol(version)
+        calls = (
+            lambda: protocol._generate_payload(HEART_BEAT),
+            lambda: protocol._generate_payload(DP_QUERY),
+            lambda: protocol._generate_payload(CONTROL, dps),
+        )
+        usecs = [
+            min(timeit.repeat(call, number=number, repeat=5)) / number * 1e6
+            for call in calls
+        ]
+        print(f"v{version:<9}" + "".join(f"{usec:>12.2f}" for usec in usecs))
+
+
+class StreamProtocol(asyncio.Protocol):
+    """Feed a TuyaProtocol through data_received, the non-buffered path."""
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def connection_made(self, transport):
+        self.protocol.connection_made(transport)
+
+    def data_received(self, data):
+        self.protocol.data_received(data)
+
+
+async def _transport_run(buffered, version, connections, rounds):
+    loop = asyncio.get_running_loop()
+    frame = make_encrypted_frame(version, 1, b'{"dps":{"1":true}}')
+    expected = 0
+    received = 0
+    waiter = None
+
+    class CountListener(BenchListener):
+        def status_updated(self, status):
+            nonlocal received
+            received += 1
+            if received == expected:
+                waiter.set_result(None)
+
+    listener = CountListener()
+    writers, transports = [], []
+    for _ in range(connections):
+        reader, writer = socket.socketpair()
+        writer.setblocking(False)
+        protocol = TuyaProtocol(DEV_ID, LOCAL_KEY.decode(), version, False, listener)
+        factory = (lambda p=protocol: p) if buffered else (lambda p=protocol: StreamProtocol(p))
+        transport, _ = await loop.create_connection(factory, sock=reader)
+        writers.append(writer)
+        transports.append(transport)
+
+    async def _round():
+        nonlocal expected, waiter
+        expected += connections
+        waiter = loop.create_future()
+        for writer in writers:
+            writer.send(frame)
+        await waiter
+
+    # Warm up, the read buffers are allocated on the first read.
+    await _round()
+    if tracemalloc.is_tracing():
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await _round()
+    elapsed = time.perf_counter() - start
+    if tracemalloc.is_tracing():
+        elapsed = tracemalloc.get_traced_memory()[1] - base
+
+    for transport, writer in zip(transports, writers):
+        transport.close()
+        writer.close()
+    return elapsed
+
+
+def bench_transport(connections=200, rounds=50):
+    """Deliver one status frame per read to many connections over socketpairs."""
+    print("TuyaProtocol socket reads (frames/s and peak KiB allocated while reading)")
+    print(f"{'version':<10}{'data_received':>15}{'buffered':>12}{'KiB':>10}{'KiB':>10}")
+    frames = connections * rounds
+    for version in VERSIONS:
+        streamed, buffered = (
+            min(
+                asyncio.run(_transport_run(mode, version, connections, rounds))
+                for _ in range(5)
+            )
+            for mode in (False, True)
+        )
+        tracemalloc.start()
+        streamed_peak, buffered_peak = (
+            asyncio.run(_transport_run(mode, version, connections, rounds)) / 1024
+            for mode in (False, True)
+        )
+        tracemalloc.stop()
+        print(
+            f"v{version:<9}{frames / streamed:>15.0f}{frames / buffered:>12.0f}"
+            f"{streamed_peak:>10.0f}{buffered_peak:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    bench_reassembly()
+    print()
+    bench_crypto()
+    print()
+    bench_payload()
+    print()
+    bench_transport()
@@ -54,6 +54,7 @@ from hashlib import md5, sha256
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 version_tuple = (2024, 6, 0)
 version = version_string = __version__ = "%d.%d.%d" % version_tuple
@@ -176,6 +177,7 @@ PREFIX_6699_VALUE = 0x00006699
 PREFIX_6699_BIN = b"\x00\x00\x66\x99"
 SUFFIX_6699_VALUE = 0x00009966
 SUFFIX_6699_BIN = b"\x00\x00\x99\x66"
+PREFIXES_BIN = (PREFIX_55AA_BIN, PREFIX_6699_BIN)
 
 NO_PROTOCOL_HEADER_CMDS = [
     DP_QUERY,
@@ -191,6 +193,8 @@ NO_PROTOCOL_HEADER_CMDS = [
 HEARTBEAT_INTERVAL = 8.3
 TIMEOUT_CONNECT = 5
 TIMEOUT_REPLY = 5
+# Size of the per-connection buffer the transport reads into.
+READ_BUFFER_SIZE = 4096
 
 # DPS that are known to be safe to use with update_dps (0x12) command
 UPDATE_DPS_WHITELIST = [18, 19, 20]  # Socket (Wi-Fi)
@@ -255,6 +259,71 @@ payload_dict = {
 }
 
 
+# Payload keys that are filled per request, everything else is serialized once.
+PAYLOAD_DYNAMIC_KEYS = ("gwId", "devId", "uid", "cid", "t", "data", "dpId", "reqType")
+
+
+def json_compact(value) -> bytes:
+    """Serialize value to JSON bytes without any whitespace between tokens."""
+    # if spaces are not removed device does not respond!
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+class PayloadTemplate:
+    """Command payload of payload_dict compiled for a device type and command."""
+
+    def __init__(self, dev_type: str, command: int):
+        """Resolve the payload overrides and pre-serialize the static keys."""
+        json_data = command_override = None
+        for source in (dev_type, "type_0a"):
+            overrides = payload_dict[source].get(command, {})
+            if json_data is None:
+                json_data = overrides.get("command")
+            if command_override is None:
+                command_override = overrides.get("command_override")
+
+        if json_data is None:
+            # I have yet to see a device complain about included but unneeded attribs, but they *will*
+            # complain about missing attribs, so just include them all unless otherwise specified
+            json_data = {"gwId": "", "devId": "", "uid": "", "t": "", "cid": ""}
+
+        self.command = command_override if command_override is not None else command
+        self.keys = frozenset(json_data)
+        self.defaults = {
+            k: v for k, v in json_data.items() if k in PAYLOAD_DYNAMIC_KEYS
+        }
+        self._fields = [
+            (key, None if key in self.defaults else self._field(key, value))
+            for key, value in json_data.items()
+        ]
+
+    @staticmethod
+    def _field(key: str, value) -> bytes:
+        return b'"' + key.encode("utf-8") + b'":' + json_compact(value)
+
+    def render(self, values: dict) -> bytes:
+        """Return the payload bytes, values holds the dynamic keys to include."""
+        fields = [
+            static if static is not None else self._field(key, values[key])
+            for key, static in self._fields
+            if static is not None or key in values
+        ]
+        if "dps" in values:
+            fields.append(self._field("dps", values["dps"]))
+        return b"{" + b",".join(fields) + b"}"
+
+
+_payload_templates: dict[tuple[str, int], PayloadTemplate] = {}
+
+
+def get_payload_template(dev_type: str, command: int) -> PayloadTemplate:
+    """Return the compiled payload template of command for dev_type."""
+    if (template := _payload_templates.get((dev_type, command))) is None:
+        template = PayloadTemplate(dev_type, command)
+        _payload_templates[(dev_type, command)] = template
+    return template
+
+
 class TuyaLoggingAdapter(logging.LoggerAdapter):
     """Adapter that adds device id to all log points."""
 
@@ -317,8 +386,12 @@ class ContextualLogger:
         return self._logger.exception(msg, *args)
 
 
-def pack_message(msg, hmac_key=None):
-    """Pack a TuyaMessage into bytes."""
+def pack_message(msg, hmac_key=None, crypto=None):
+    """Pack a TuyaMessage into bytes.
+
+    crypto is an optional SessionCrypto for hmac_key, its cached cipher and HMAC
+    are used instead of creating new ones for this message.
+    """
     if msg.prefix == PREFIX_55AA_VALUE:
         header_fmt = MESSAGE_HEADER_FMT_55AA
         end_fmt = MESSAGE_END_FMT_HMAC if hmac_key else MESSAGE_END_FMT_55AA
@@ -342,7 +415,7 @@ def pack_message(msg, hmac_key=None):
     data = struct.pack(header_fmt, *header_data)
 
     if msg.prefix == PREFIX_6699_VALUE:
-        cipher = AESCipher(hmac_key)
+        cipher = crypto.cipher if crypto else AESCipher(hmac_key)
         if type(msg.retcode) == int:
             raw = struct.pack(MESSAGE_RETCODE_FMT, msg.retcode) + msg.payload
         else:
@@ -357,7 +430,9 @@ def pack_message(msg, hmac_key=None):
         data += data2 + SUFFIX_6699_BIN
     else:
         data += msg.payload
-        if hmac_key:
+        if crypto:
+            crc = crypto.hmac(data)
+        elif hmac_key:
             crc = hmac.new(hmac_key, data, sha256).digest()
         else:
             crc = binascii.crc32(data) & 0xFFFFFFFF
@@ -367,8 +442,15 @@ def pack_message(msg, hmac_key=None):
     return data
 
 
-def unpack_message(data, hmac_key=None, header=None, no_retcode=False, logger=_LOGGER):
-    """Unpack bytes into a TuyaMessage."""
+def unpack_message(
+    data, hmac_key=None, header=None, no_retcode=False, logger=_LOGGER, crypto=None
+):
+    """Unpack bytes into a TuyaMessage.
+
+    data may be bytes or a memoryview slice of the receive buffer, the returned
+    message always holds its own bytes copy of the payload.
+    crypto is an optional SessionCrypto for hmac_key, see pack_message().
+    """
     if header is None:
         header = parse_header(data)
 
@@ -396,31 +478,25 @@ def unpack_message(data, hmac_key=None, header=None, no_retcode=False, logger=_L
             header_len + header.length,
             len(data),
         )
-        raise DecodeError(f"Not enough data to unpack payload: {data}")
+        raise DecodeError(f"Not enough data to unpack payload: {bytes(data)}")
 
     end_len = struct.calcsize(end_fmt)
     # the retcode is technically part of the payload, but strip it as we do not want it here
     retcode = (
         0
         if not retcode_len
-        else struct.unpack(
-            MESSAGE_RETCODE_FMT, data[header_len : header_len + retcode_len]
-        )[0]
+        else struct.unpack_from(MESSAGE_RETCODE_FMT, data, header_len)[0]
     )
-    payload = data[header_len + retcode_len : msg_len]
-    crc, suffix = struct.unpack(end_fmt, payload[-end_len:])
-    payload = payload[:-end_len]
+    crc, suffix = struct.unpack_from(end_fmt, data, msg_len - end_len)
+    payload = data[header_len + retcode_len : msg_len - end_len]
 
     if header.prefix == PREFIX_55AA_VALUE:
-        if hmac_key:
-            have_crc = hmac.new(
-                hmac_key, data[: (header_len + header.length) - end_len], sha256
-            ).digest()
+        if crypto:
+            have_crc = crypto.hmac(data[: msg_len - end_len])
+        elif hmac_key:
+            have_crc = hmac.new(hmac_key, data[: msg_len - end_len], sha256).digest()
         else:
-            have_crc = (
-                binascii.crc32(data[: (header_len + header.length) - end_len])
-                & 0xFFFFFFFF
-            )
+            have_crc = binascii.crc32(data[: msg_len - end_len]) & 0xFFFFFFFF
 
         if suffix != SUFFIX_VALUE:
             logger.debug("Suffix prefix wrong! %08X != %08X", suffix, SUFFIX_VALUE)
@@ -437,10 +513,10 @@ def unpack_message(data, hmac_key=None, header=None, no_retcode=False, logger=_L
         crc_good = crc == have_crc
         iv = None
     elif header.prefix == PREFIX_6699_VALUE:
-        iv = payload[:12]
+        iv = bytes(payload[:12])
         payload = payload[12:]
         try:
-            cipher = AESCipher(hmac_key)
+            cipher = crypto.cipher if crypto else AESCipher(hmac_key)
             payload = cipher.decrypt(
                 payload,
                 use_base64=False,
@@ -469,12 +545,19 @@ def unpack_message(data, hmac_key=None, header=None, no_retcode=False, logger=_L
             payload = payload[retcode_len:]
 
     return TuyaMessage(
-        header.seqno, header.cmd, retcode, payload, crc, crc_good, header.prefix, iv
+        header.seqno,
+        header.cmd,
+        retcode,
+        bytes(payload),
+        crc,
+        crc_good,
+        header.prefix,
+        iv,
     )
 
 
 def parse_header(data, logger=_LOGGER):
-    """Unpack bytes into a TuyaHeader."""
+    """Unpack bytes (or a memoryview of them) into a TuyaHeader."""
     if data[:4] == PREFIX_6699_BIN:
         fmt = MESSAGE_HEADER_FMT_6699
     else:
@@ -487,7 +570,7 @@ def parse_header(data, logger=_LOGGER):
         logger.error(err)
         raise DecodeError(err)
 
-    unpacked = struct.unpack(fmt, data[:header_len])
+    unpacked = struct.unpack_from(fmt, data)
     prefix = unpacked[0]
 
     if prefix == PREFIX_55AA_VALUE:
@@ -519,6 +602,14 @@ class AESCipher:
         self.block_size = 16
         self.key = key
         self.cipher = Cipher(algorithms.AES(key), modes.ECB(), default_backend())
+        self._gcm: AESGCM | None = None
+
+    @property
+    def gcm(self) -> AESGCM:
+        """Return the AES-GCM object for the key, created on first use."""
+        if self._gcm is None:
+            self._gcm = AESGCM(self.key)
+        return self._gcm
 
     def encrypt(self, raw, use_base64=True, pad=True, iv=False, header=None):
         """Encrypt data to be sent to device."""
@@ -528,11 +619,8 @@ class AESCipher:
                     iv = b"0123456789ab"
                 else:
                     iv = str(time.time() * 10)[:12].encode("utf8")
-            encryptor = Cipher(algorithms.AES(self.key), modes.GCM(iv)).encryptor()
-            if header:
-                encryptor.authenticate_additional_data(header)
-            crypted_text = encryptor.update(raw) + encryptor.finalize()
-            crypted_text = iv + crypted_text + encryptor.tag
+            # AESGCM appends the 16 bytes tag to the encrypted data.
+            crypted_text = iv + self.gcm.encrypt(iv, raw, header or None)
         else:
             encryptor = self.cipher.encryptor()
             if pad:
@@ -556,13 +644,9 @@ class AESCipher:
                 decryptor = Cipher(
                     algorithms.AES(self.key), modes.CTR(iv + b"\x00\x00\x00\x02")
                 ).decryptor()
+                raw = decryptor.update(enc) + decryptor.finalize()
             else:
-                decryptor = Cipher(
-                    algorithms.AES(self.key), modes.GCM(iv, tag)
-                ).decryptor()
-            if header and (tag is not None):
-                decryptor.authenticate_additional_data(header)
-            raw = decryptor.update(enc) + decryptor.finalize()
+                raw = self.gcm.decrypt(iv, bytes(enc) + tag, bytes(header or b""))
         else:
             decryptor = self.cipher.decryptor()
             raw = decryptor.update(enc) + decryptor.finalize()
@@ -579,127 +663,205 @@ class AESCipher:
         return data[: -ord(data[len(data) - 1 :])]
 
 
+class SessionCrypto:
+    """Crypto objects for a (real key, session key) pair, created once per session."""
+
+    def __init__(self, real_key: bytes, session_key: bytes | None = None):
+        """Initialize the ciphers and HMAC template for the keys."""
+        self.real_key = real_key
+        self.key = session_key or real_key
+        self.cipher = AESCipher(self.key)
+        self.real_cipher = (
+            self.cipher if self.key == real_key else AESCipher(self.real_key)
+        )
+        self._hmac = hmac.new(self.key, digestmod=sha256)
+
+    def hmac(self, data) -> bytes:
+        """Return the HMAC-SHA256 digest of data using the pre-keyed template."""
+        mac = self._hmac.copy()
+        mac.update(data)
+        return mac.digest()
+
+
 class MessageDispatcher(ContextualLogger):
     """Buffer and dispatcher for Tuya messages."""
 
-    # Heartbeats on protocols < 3.3 respond with sequence number 0,
-    # so they can't be waited for like other messages.
-    # This is a hack to allow waiting for heartbeats.
-    HEARTBEAT_SEQNO = -100
-    RESET_SEQNO = -101
-    SESS_KEY_SEQNO = -102
-    SUB_DEVICE_QUERY_SEQNO = -103
+    # Replies which may not carry the sequence number of the request, e.g.
+    # heartbeats on protocols < 3.3 respond with sequence number 0. These are
+    # matched to the oldest pending request of the command they answer.
+    REPLY_REQUESTS = {
+        HEART_BEAT: HEART_BEAT,
+        UPDATEDPS: UPDATEDPS,
+        SESS_KEY_NEG_RESP: SESS_KEY_NEG_START,
+        LAN_EXT_STREAM: LAN_EXT_STREAM,
+    }
 
     def __init__(self, dev_id, callback_status_update, protocol_version, local_key):
         """Initialize a new MessageBuffer."""
         super().__init__()
-        self.buffer = b""
-        self.listeners: dict[str, asyncio.Semaphore] = {}
+        self.buffer = bytearray()
+        self._pending_length = 0
+        self._read_buffer: memoryview | None = None
+        self.pending: dict[tuple[int, int], asyncio.Future] = {}
         self.callback_status_update = callback_status_update
         self.version = protocol_version
-        self.local_key = local_key
+        self.crypto = SessionCrypto(local_key)
 
     def abort(self):
         """Abort all waiting clients."""
-        for key in self.listeners:
-            sem = self.listeners[key]
-            self.listeners[key] = None
-
-            # TODO: Received data and semahore should be stored separately
-            if isinstance(sem, asyncio.Semaphore):
-                sem.release()
-
-    async def wait_for(self, seqno, cmd, timeout=TIMEOUT_REPLY):
-        """Wait for response to a sequence number to be received and return it."""
-        if seqno in self.listeners:
-            self.debug(f"listener exists for {seqno}")
-            if seqno == self.HEARTBEAT_SEQNO:
-                raise Exception(f"listener exists for {seqno}")
-
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_result(None)
+
+    def expect(self, seqno, cmd) -> asyncio.Future:
+        """Register a request and return the future resolved with its reply."""
+        key = (seqno, cmd)
+        future = self.pending.get(key)
+        if future is None or future.done():
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key] = future
+        return future
+
+    async def wait_for(self, seqno, cmd, timeout=TIMEOUT_REPLY, future=None):
+        """Wait for the reply to the request with sequence number and command.
+
+        Pass the future returned by expect() to wait for a request registered
+        before it was sent, an aborted request then returns None right away.
+        """
         self.debug("Command %d waiting for seq. number %d", cmd, seqno)
-        self.listeners[seqno] = asyncio.Semaphore(0)
+        future = future or self.expect(seqno, cmd)
         try:
-            await asyncio.wait_for(self.listeners[seqno].acquire(), timeout=timeout)
-        except asyncio.TimeoutError:
+            async with asyncio.timeout(timeout):
+                return await future
+        except TimeoutError:
             self.debug(
                 "Command %d timed out waiting for sequence number %d", cmd, seqno
             )
-            del self.listeners[seqno]
             raise TimeoutError(
                 f"Command {cmd} timed out waiting for sequence number {seqno}"
             )
-        return self.listeners.pop(seqno)
+        finally:
+            self.discard(seqno, cmd, future)
+
+    def discard(self, seqno, cmd, future=None):
+        """Stop waiting for the reply to a request, e.g. if sending was cancelled."""
+        key = (seqno, cmd)
+        if future is None or self.pending.get(key) is future:
+            if (future := self.pending.pop(key, None)) is not None:
+                future.cancel()
 
     def add_data(self, data):
         """Add new data to the buffer and try to parse messages."""
         self.buffer += data
-
+        # Skip parsing until the pending message has been fully received.
+        if len(self.buffer) >= self._pending_length:
+            self._parse_buffer()
+
+    def get_buffer(self) -> memoryview:
+        """Return the preallocated buffer the transport reads into."""
+        if self._read_buffer is None:
+            self._read_buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+        return self._read_buffer
+
+    def buffer_updated(self, nbytes):
+        """Add the bytes the transport wrote into the read buffer."""
+        self.add_data(self._read_buffer[:nbytes])
+
+    def _parse_buffer(self):
+        """Unpack every complete message held in the buffer and dispatch it.
+
+        Messages are unpacked from memoryview slices while a read cursor walks
+        over the buffer, consumed bytes are dropped once at the end of the call
+        instead of re-slicing the buffer after every message.
+        """
+        buffer = self.buffer
         header_len = struct.calcsize(MESSAGE_RECV_HEADER_FMT)
-        while self.buffer:
-            # Check if enough data for measage header
-            if len(self.buffer) < header_len:
-                break
-
-            prefix_offset_55AA = self.buffer.find(PREFIX_55AA_BIN)
-            prefix_offset_6699 = self.buffer.find(PREFIX_6699_BIN)
-            prefixes = (prefix_offset_55AA, prefix_offset_6699)
-
-            # If somehow we got unexpected message, we will ignore it and reset the buffer.
-            if prefix_offset_55AA < 0 and prefix_offset_6699 < 0:
-                self.debug(f"Got unexpected Message prefix: {self.buffer}", force=True)
-                self.buffer = b""
-                break
-
-            # If the prefix is not at the start of the message.
-            if prefix_offset_55AA != 0 and prefix_offset_6699 != 0:
-                self.debug(f"Message prefix offset not at the start {self.buffer}")
-                prefix_offset = min(prefix for prefix in prefixes if not prefix < 0)
-                self.buffer = self.buffer[prefix_offset:]
-
-            header = parse_header(self.buffer, logger=self)
-            # Check if the all data for the message has been received.
-            if len(self.buffer) < header.total_length:
-                break
-
-            hmac_key = self.local_key if self.version >= 3.4 else None
-            no_retcode = False
-            msg = unpack_message(
-                self.buffer,
-                header=header,
-                hmac_key=hmac_key,
-                no_retcode=no_retcode,
-                logger=self,
+        crypto = self.crypto if self.version >= 3.4 else None
+        hmac_key = crypto and crypto.key
+        offset = 0
+        self._pending_length = 0
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - offset >= header_len:
+                # Messages are usually aligned, only scan if the prefix isn't at the cursor.
+                if not buffer.startswith(PREFIXES_BIN, offset):
+                    prefix_offset = self._find_prefix(buffer, offset)
+                    # If somehow we got unexpected message, we will ignore it.
+                    if prefix_offset < 0:
+                        self.debug(
+                            f"Got unexpected Message prefix: {bytes(buffer[offset:])}",
+                            force=True,
+                        )
+                        # Keep the tail in case it holds the start of a split prefix.
+                        offset = max(offset, len(buffer) - (len(PREFIX_55AA_BIN) - 1))
+                        break
+
+                    self.debug(
+                        f"Message prefix offset not at the start {bytes(buffer[offset:])}"
+                    )
+                    offset = prefix_offset
+                    continue
+
+                header = parse_header(view[offset:], logger=self)
+                # Check if the all data for the message has been received.
+                if len(buffer) - offset < header.total_length:
+                    self._pending_length = header.total_length
+                    break
+
+                msg = unpack_message(
+                    view[offset : offset + header.total_length],
+                    header=header,
+                    hmac_key=hmac_key,
+                    no_retcode=False,
+                    logger=self,
+                    crypto=crypto,
+                )
+                offset += header.total_length
+                self._dispatch(msg)
+        except Exception:
+            # The traceback may still hold views of the buffer, so it can't be resized.
+            self.buffer = buffer[offset:]
+            raise
+        finally:
+            view.release()
+
+        if offset:
+            del buffer[:offset]
+
+    @staticmethod
+    def _find_prefix(buffer, start):
+        """Return the offset of the first message prefix found after start, or -1."""
+        offsets = [
+            found
+            for found in (
+                buffer.find(PREFIX_55AA_BIN, start),
+                buffer.find(PREFIX_6699_BIN, start),
             )
-            self.buffer = self.buffer[header.total_length :]
-            self._dispatch(msg)
+            if found >= 0
+        ]
+        return min(offsets) if offsets else -1
 
     def _dispatch(self, msg):
         """Dispatch a message to someone that is listening."""
 
         self.debug("Dispatching message CMD %r %s", msg.cmd, msg)
 
-        if msg.seqno in self.listeners:
-            self.debug("Dispatching sequence number %d", msg.seqno)
-            self._release_listener(msg.seqno, msg)
+        resolved = self._resolve(msg)
 
         if msg.cmd == HEART_BEAT:
             self.debug("Got heartbeat response")
-            self._release_listener(self.HEARTBEAT_SEQNO, msg)
         elif msg.cmd == UPDATEDPS:
             self.debug("Got normal updatedps response")
-            self._release_listener(self.RESET_SEQNO, msg)
         elif msg.cmd == SESS_KEY_NEG_RESP:
             self.debug("Got key negotiation response")
-            self._release_listener(self.SESS_KEY_SEQNO, msg)
         elif msg.cmd == STATUS:
-            if self.RESET_SEQNO in self.listeners:
+            if self._resolve_oldest(UPDATEDPS, msg):
                 self.debug("Got reset status update")
-                self._release_listener(self.RESET_SEQNO, msg)
             else:
                 self.debug("Got status update")
                 self.callback_status_update(msg)
         elif msg.cmd == LAN_EXT_STREAM:
-            self._release_listener(self.SUB_DEVICE_QUERY_SEQNO, msg)
             if msg.payload:
                 self.debug(f"Got Sub-devices status update")
                 self.callback_status_update(msg)
@@ -709,7 +871,7 @@ class MessageDispatcher(ContextualLogger):
                     "Got ACK message for command %d: ignoring it %s", msg.cmd, msg.seqno
                 )
                 self.callback_status_update(msg, ack=True)
-            elif msg.seqno not in self.listeners:
+            elif not resolved:
                 self.debug(
                     "Got message type %d for unknown listener %d: %s",
                     msg.cmd,
@@ -717,16 +879,36 @@ class MessageDispatcher(ContextualLogger):
                     msg,
                 )
 
-    def _release_listener(self, seqno, msg):
-        if seqno not in self.listeners:
-            return
+    def _resolve(self, msg) -> bool:
+        """Resolve the pending request the message is a reply to."""
+        key = (msg.seqno, msg.cmd)
+        if key not in self.pending:
+            # Replies may use another command than the request, e.g. CONTROL.
+            key = next((k for k in self.pending if k[0] == msg.seqno), None)
 
-        sem = self.listeners[seqno]
-        if isinstance(sem, asyncio.Semaphore):
-            self.listeners[seqno] = msg
-            sem.release()
-        else:
-            self.debug(f"{seqno} - Got additional message without request: skip {sem}")
+        if key is not None:
+            self.debug("Dispatching sequence number %d", msg.seqno)
+            if self._set_reply(key, msg):
+                return True
+
+        if (cmd := self.REPLY_REQUESTS.get(msg.cmd)) is not None:
+            return self._resolve_oldest(cmd, msg)
+        return False
+
+    def _resolve_oldest(self, cmd, msg) -> bool:
+        """Resolve the oldest pending request for command with the message."""
+        for key in self.pending:
+            if key[1] == cmd and not self.pending[key].done():
+                return self._set_reply(key, msg)
+        return False
+
+    def _set_reply(self, key, msg) -> bool:
+        future = self.pending.pop(key)
+        if future.done():
+            self.debug(f"{key} - Got additional message without request: skip")
+            return False
+        future.set_result(msg)
+        return True
 
 
 class TuyaListener(ABC):
@@ -760,8 +942,12 @@ class EmptyListener(TuyaListener):
         """Device is offline or online."""
 
 
-class TuyaProtocol(asyncio.Protocol, ContextualLogger):
-    """Implementation of the Tuya protocol."""
+class TuyaProtocol(asyncio.BufferedProtocol, ContextualLogger):
+    """Implementation of the Tuya protocol.
+
+    Transports that support buffered reads receive into a buffer owned by the
+    dispatcher, any other transport falls back to data_received.
+    """
 
     def __init__(
         self,
@@ -797,11 +983,11 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             # them (such as BulbDevice) make connections when called
             TuyaProtocol.set_version(self, 3.1)
 
-        self.cipher = AESCipher(self.local_key)
         self.seqno = 1
         self.transport = None
         self.listener = weakref.ref(listener)
         self.dispatcher = self._setup_dispatcher()
+        self._crypto: SessionCrypto = self.dispatcher.crypto
         self.heartbeater: asyncio.Task | None = None
         self._sub_devs_query_task: asyncio.Task | None = None
         self.dps_cache = {}
@@ -812,6 +998,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         self.dispatched_dps = {}  # Store payload so we can trigger an event in HA.
         self._last_command_sent = 1  # The time last command was sent
         self._write_lock = asyncio.Lock()  # To serialize writes
+        self._session_lock = asyncio.Lock()  # To negotiate the session key once
         self.enable_debug(enable_debug)
 
     def set_version(self, protocol_version):
@@ -984,6 +1171,14 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
                 )
             )
 
+    def get_buffer(self, sizehint):
+        """Return the buffer the transport should read into."""
+        return self.dispatcher.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        """Received nbytes from device into the read buffer."""
+        self.dispatcher.buffer_updated(nbytes)
+
     def data_received(self, data):
         """Received data from device."""
         # self.debug("received data=%r", binascii.hexlify(data), force=True)
@@ -1026,6 +1221,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         """Clean up session."""
         self.debug(f"Cleaning up session.")
         self.real_local_key = self.local_key
+        self._set_crypto(SessionCrypto(self.real_local_key))
 
         if self.heartbeater:
             self.heartbeater.cancel()
@@ -1044,12 +1240,14 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         if not self.is_connected:
             self.debug("send quick failed, could not get socket: %s", payload)
             return None
+        seqno = self.seqno
         enc_payload = (
             self._encode_message(payload)
             if isinstance(payload, MessagePayload)
             else payload
         )
         # self.debug("Quick-dispatching message %s, seqno %s", binascii.hexlify(enc_payload), self.seqno)
+        future = self.dispatcher.expect(seqno, payload.cmd) if recv_retries else None
 
         try:
             await self.transport_write(enc_payload)
@@ -1058,8 +1256,8 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
 
         while recv_retries:
             try:
-                seqno = MessageDispatcher.SESS_KEY_SEQNO
-                msg = await self.dispatcher.wait_for(seqno, payload.cmd)
+                msg = await self.dispatcher.wait_for(seqno, payload.cmd, future=future)
+                future = None
                 # for 3.4 devices, we get the starting seqno with the SESS_KEY_NEG_RESP message
                 self.seqno = msg.seqno
             except Exception:  # pylint: disable=broad-except
@@ -1085,9 +1283,12 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             return None
 
         if self.version >= 3.4 and self.real_local_key == self.local_key:
-            self.debug("3.4 or 3.5 device: negotiating a new session key")
-            if not await self._negotiate_session_key():
-                return self.clean_up_session()
+            async with self._session_lock:
+                # Another command may have negotiated while this one was waiting.
+                if self.real_local_key == self.local_key:
+                    self.debug("3.4 or 3.5 device: negotiating a new session key")
+                    if not await self._negotiate_session_key():
+                        return self.clean_up_session()
 
         self.debug(
             "Sending command %s (device type: %s) DPS: %s", command, self.dev_type, dps
@@ -1096,23 +1297,20 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         real_cmd = payload.cmd
         dev_type = self.dev_type
 
-        # Wait for special sequence number
+        # Register before writing, replies are matched by (seqno, cmd) so several
+        # commands can be in flight at once.
         seqno = self.seqno
-
-        if payload.cmd == HEART_BEAT:
-            seqno = MessageDispatcher.HEARTBEAT_SEQNO
-        elif payload.cmd == UPDATEDPS:
-            seqno = MessageDispatcher.RESET_SEQNO
-        elif payload.cmd == LAN_EXT_STREAM:
-            seqno = MessageDispatcher.SUB_DEVICE_QUERY_SEQNO
-
         enc_payload = self._encode_message(payload)
+        future = self.dispatcher.expect(seqno, payload.cmd)
 
         try:
             await self.transport_write(enc_payload)
+        except asyncio.CancelledError:
+            self.dispatcher.discard(seqno, payload.cmd, future)
+            raise
         except Exception:  # pylint: disable=broad-except
             return self.clean_up_session()
-        msg = await self.dispatcher.wait_for(seqno, payload.cmd)
+        msg = await self.dispatcher.wait_for(seqno, payload.cmd, future=future)
         if msg is None:
             self.debug("Wait was aborted for seqno %d", seqno)
             return None
@@ -1260,7 +1458,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             self.dps_to_request.update({str(index): None for index in dp_indicies})
 
     def _decode_payload(self, payload):
-        cipher = AESCipher(self.local_key)
+        cipher = self._crypto.cipher
 
         if self.version == 3.4:
             # 3.4 devices encrypt the version header in addition to the payload
@@ -1358,9 +1556,15 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             self.dispatched_dps = json_payload["dps"]
         return json_payload
 
+    def _set_crypto(self, crypto: SessionCrypto):
+        """Use the crypto context for the messages sent and received."""
+        self._crypto = self.dispatcher.crypto = crypto
+
     async def _negotiate_session_key(self):
         self.remote_nonce = b""
         self.local_key = self.real_local_key
+        if (self._crypto.real_key, self._crypto.key) != (self.local_key,) * 2:
+            self._set_crypto(SessionCrypto(self.real_local_key))
 
         rkey = await self.exchange_quick(
             MessagePayload(SESS_KEY_NEG_START, self.local_nonce), 2
@@ -1380,7 +1584,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         if self.version == 3.4:
             try:
                 # self.debug("decrypting %r using %r", payload, self.real_local_key)
-                cipher = AESCipher(self.real_local_key)
+                cipher = self._crypto.real_cipher
                 payload = cipher.decrypt(payload, False, decode_text=False)
             except Exception as ex:
                 self.debug(
@@ -1398,7 +1602,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             return False
 
         self.remote_nonce = payload[:16]
-        hmac_check = hmac.new(self.local_key, self.local_nonce, sha256).digest()
+        hmac_check = self._crypto.hmac(self.local_nonce)
 
         if hmac_check != payload[16:48]:
             self.debug(
@@ -1408,7 +1612,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             )
 
         # self.debug("session local nonce: %r remote nonce: %r", self.local_nonce, self.remote_nonce)
-        rkey_hmac = hmac.new(self.local_key, self.remote_nonce, sha256).digest()
+        rkey_hmac = self._crypto.hmac(self.remote_nonce)
         await self.exchange_quick(MessagePayload(SESS_KEY_NEG_FINISH, rkey_hmac), None)
 
         self.local_key = bytes(
@@ -1416,17 +1620,16 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         )
         # self.debug("Session nonce XOR'd: %r" % self.local_key)
 
-        cipher = AESCipher(self.real_local_key)
+        cipher = self._crypto.real_cipher
         if self.version == 3.4:
-            self.local_key = self.dispatcher.local_key = cipher.encrypt(
-                self.local_key, False, pad=False
-            )
+            self.local_key = cipher.encrypt(self.local_key, False, pad=False)
         else:
             iv = self.local_nonce[:12]
             self.debug("Session IV: %r", iv)
-            self.local_key = self.dispatcher.local_key = cipher.encrypt(
+            self.local_key = cipher.encrypt(
                 self.local_key, use_base64=False, pad=False, iv=iv
             )[12:28]
+        self._set_crypto(SessionCrypto(self.real_local_key, self.local_key))
 
         self.debug("Session key negotiate success! session key: %r", self.local_key)
         return True
@@ -1436,7 +1639,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         hmac_key = None
         iv = None
         payload = msg.payload
-        self.cipher = AESCipher(self.local_key)
+        crypto = self._crypto
 
         if self.version >= 3.4:
             hmac_key = self.local_key
@@ -1452,20 +1655,20 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
                     self.seqno, msg.cmd, None, payload, 0, True, PREFIX_6699_VALUE, True
                 )
                 self.seqno += 1  # increase message sequence number
-                data = pack_message(msg, hmac_key=self.local_key)
+                data = pack_message(msg, hmac_key=self.local_key, crypto=crypto)
                 self.debug("payload encrypted=%r", binascii.hexlify(data))
                 return data
 
-            payload = self.cipher.encrypt(payload, False)
+            payload = crypto.cipher.encrypt(payload, False)
         elif self.version >= 3.2:
             # expect to connect and then disconnect to set new
-            payload = self.cipher.encrypt(payload, False)
+            payload = crypto.cipher.encrypt(payload, False)
             if msg.cmd not in NO_PROTOCOL_HEADER_CMDS:
                 # add the 3.x header
                 payload = self.version_header + payload
         elif msg.cmd == CONTROL:
             # need to encrypt
-            payload = self.cipher.encrypt(payload)
+            payload = crypto.cipher.encrypt(payload)
             preMd5String = (
                 b"data="
                 + payload
@@ -1484,12 +1687,13 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
                 + payload
             )
 
-        self.cipher = None
         msg = TuyaMessage(
             self.seqno, msg.cmd, 0, payload, 0, True, PREFIX_55AA_VALUE, False
         )
         self.seqno += 1  # increase message sequence number
-        buffer = pack_message(msg, hmac_key=hmac_key)
+        buffer = pack_message(
+            msg, hmac_key=hmac_key, crypto=crypto if hmac_key else None
+        )
         # self.debug("payload encrypted with key %r => %r", self.local_key, binascii.hexlify(buffer))
         return buffer
 
@@ -1516,67 +1720,25 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             devId(str, optional): Will be used for devId
             uid(str, optional): Will be used for uid
         """
-        json_data = command_override = None
-
-        # Create a deep copy of payload_dict. otherwise, the original references will be overwritten
-        def deepcopy_dict(_dict: dict):
-            output = _dict.copy()
-            for key, value in output.items():
-                output[key] = deepcopy_dict(value) if isinstance(value, dict) else value
-            return output
-
-        payloads = deepcopy_dict(payload_dict)
-
-        if command in payloads[self.dev_type]:
-            if "command" in payloads[self.dev_type][command]:
-                json_data = payloads[self.dev_type][command]["command"].copy()
-            if "command_override" in payloads[self.dev_type][command]:
-                command_override = payloads[self.dev_type][command]["command_override"]
-
-        if self.dev_type != "type_0a":
-            if (
-                json_data is None
-                and command in payloads["type_0a"]
-                and "command" in payloads["type_0a"][command]
-            ):
-                json_data = payloads["type_0a"][command]["command"].copy()
-            if (
-                command_override is None
-                and command in payloads["type_0a"]
-                and "command_override" in payloads["type_0a"][command]
-            ):
-                command_override = payloads["type_0a"][command]["command_override"]
-
-        if command_override is None:
-            command_override = command
-        if json_data is None:
-            # I have yet to see a device complain about included but unneeded attribs, but they *will*
-            # complain about missing attribs, so just include them all unless otherwise specified
-            json_data = {"gwId": "", "devId": "", "uid": "", "t": "", "cid": ""}
+        template = get_payload_template(self.dev_type, command)
+        json_data = {
+            key: value.copy() if isinstance(value, dict) else value
+            for key, value in template.defaults.items()
+        }
 
         if "gwId" in json_data:
-            if gwId is not None:
-                json_data["gwId"] = gwId
-            else:
-                json_data["gwId"] = self.id
+            json_data["gwId"] = gwId if gwId is not None else self.id
         if "devId" in json_data:
-            if devId is not None:
-                json_data["devId"] = devId
-            else:
-                json_data["devId"] = self.id
+            json_data["devId"] = devId if devId is not None else self.id
         if "uid" in json_data:
-            if uid is not None:
-                json_data["uid"] = uid
-            else:
-                json_data["uid"] = self.id
+            json_data["uid"] = uid if uid is not None else self.id
         if "cid" in json_data:
             if cid := nodeId:
                 json_data["cid"] = cid
                 # for <= 3.3 we don't need `gwID`, `devID` and `uid` in payload.
                 if command in (CONTROL, DP_QUERY):
                     for k in ("gwId", "devId", "uid"):
-                        if k in json_data:
-                            json_data.pop(k)
+                        json_data.pop(k, None)
             else:
                 del json_data["cid"]
         if "data" in json_data and "cid" in json_data["data"]:
@@ -1604,15 +1766,10 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         if reqType and "reqType" in json_data:
             json_data["reqType"] = reqType
 
-        if json_data == "":
-            payload = ""
-        else:
-            payload = json.dumps(json_data)
-        # if spaces are not removed device does not respond!
-        payload = payload.replace(" ", "").encode("utf-8")
+        payload = template.render(json_data)
         self.debug("Sending payload: %s", payload)
 
-        return MessagePayload(command_override, payload)
+        return MessagePayload(template.command, payload)
 
     def enable_debug(self, enable=False, friendly_name=None):
         """Enable the debug logs for the device."""
@@ -0,0 +1,216 @@
+"""Test for localtuya pytuya protocol."""
+
+import asyncio
+import json
+import struct
+
+from custom_components.localtuya.core.pytuya import (
+    CONTROL,
+    DP_QUERY,
+    HEART_BEAT,
+    EmptyListener,
+    MessageDispatcher,
+    MessagePayload,
+    PREFIX_55AA_VALUE,
+    PREFIX_6699_VALUE,
+    STATUS,
+    TuyaMessage,
+    TuyaProtocol,
+    pack_message,
+    parse_header,
+    unpack_message,
+)
+
+DEV_ID = "767823809c9c1f458745"
+LOCAL_KEY = b"wV[NcWGUSFF`dSgO"
+VERSIONS = (3.3, 3.4, 3.5)
+
+
+def make_frame(version, seqno, payload, key=LOCAL_KEY):
+    """Return a device -> client frame as it would be received on the wire."""
+    if version >= 3.5:
+        msg = TuyaMessage(seqno, STATUS, 0, payload, 0, True, PREFIX_6699_VALUE, True)
+        return pack_message(msg, hmac_key=key)
+
+    payload = struct.pack(">I", 0) + payload
+    msg = TuyaMessage(seqno, STATUS, 0, payload, 0, True, PREFIX_55AA_VALUE, None)
+    return pack_message(msg, hmac_key=key if version >= 3.4 else None)
+
+
+def make_dispatcher(version):
+    received = []
+    dispatcher = MessageDispatcher(
+        DEV_ID, lambda msg, ack=False: received.append(msg), version, LOCAL_KEY
+    )
+    return dispatcher, received
+
+
+def test_unpack_memoryview():
+    for version in VERSIONS:
+        frame = make_frame(version, 7, b'{"dps":{"1":true}}')
+        view = memoryview(bytearray(frame))
+        key = LOCAL_KEY if version >= 3.4 else None
+
+        msg = unpack_message(view, hmac_key=key, header=parse_header(view))
+        assert msg == unpack_message(frame, hmac_key=key)
+        assert type(msg.payload) is bytes
+        assert msg.payload == b'{"dps":{"1":true}}'
+        assert msg.seqno == 7 and msg.crc_good
+
+
+def test_add_data_coalesced_and_fragmented():
+    payloads = [b'{"dps":{"%d":%d}}' % (i, i) for i in range(1, 6)]
+    for version in VERSIONS:
+        stream = b"".join(make_frame(version, i, p) for i, p in enumerate(payloads))
+
+        # Several frames delivered by a single read, with leading garbage.
+        dispatcher, received = make_dispatcher(version)
+        dispatcher.add_data(b"\x01\x02\x03" + stream)
+        assert [msg.payload for msg in received] == payloads
+        assert not dispatcher.buffer
+
+        # The same stream split into tiny reads.
+        dispatcher, received = make_dispatcher(version)
+        for i in range(0, len(stream), 5):
+            dispatcher.add_data(stream[i : i + 5])
+        assert [msg.payload for msg in received] == payloads
+        assert [msg.seqno for msg in received] == list(range(len(payloads)))
+        assert not dispatcher.buffer
+
+
+def test_add_data_partial_frame():
+    frame = make_frame(3.3, 1, b'{"dps":{"1":true}}')
+    dispatcher, received = make_dispatcher(3.3)
+
+    dispatcher.add_data(frame + frame[:20])
+    assert len(received) == 1
+    assert bytes(dispatcher.buffer) == frame[:20]
+
+    dispatcher.add_data(frame[20:])
+    assert len(received) == 2
+    assert not dispatcher.buffer
+
+
+def test_buffer_updated_reads_into_preallocated_buffer():
+    payloads = [b'{"dps":{"%d":%d}}' % (i, i) for i in range(1, 4)]
+    stream = b"".join(make_frame(3.4, i, p) for i, p in enumerate(payloads))
+    dispatcher, received = make_dispatcher(3.4)
+
+    read_buffer = dispatcher.get_buffer()
+    for i in range(0, len(stream), 30):
+        chunk = stream[i : i + 30]
+        buf = dispatcher.get_buffer()
+        assert buf is read_buffer
+        buf[: len(chunk)] = chunk
+        dispatcher.buffer_updated(len(chunk))
+
+    assert [msg.payload for msg in received] == payloads
+    assert not dispatcher.buffer
+
+
+async def test_session_crypto_reused():
+    listener = EmptyListener()
+    for version in VERSIONS:
+        protocol = TuyaProtocol(DEV_ID, LOCAL_KEY.decode(), version, False, listener)
+        crypto = protocol._crypto
+        assert protocol.dispatcher.crypto is crypto
+
+        control = MessagePayload(CONTROL, b'{"dps":{"1":true}}')
+        first, second = protocol._encode_message(control), protocol._encode_message(
+            control
+        )
+        assert first != second  # seqno increased
+        assert protocol._crypto is crypto
+
+        protocol.clean_up_session()
+        assert protocol._crypto is not crypto
+        assert protocol.dispatcher.crypto is protocol._crypto
+
+
+async def test_generate_payload_compact():
+    listener = EmptyListener()
+    for version in VERSIONS:
+        protocol = TuyaProtocol(DEV_ID, LOCAL_KEY.decode(), version, False, listener)
+        dps = {"1": True, "2": "a b", "3": 10}
+        payload = protocol._generate_payload(CONTROL, dps)
+        assert b" " not in payload.payload.replace(b"a b", b"")
+        data = json.loads(payload.payload)
+        if version >= 3.4:
+            assert data["data"]["dps"] == dps
+        else:
+            assert data["dps"] == dps
+            assert data["devId"] == DEV_ID
+
+        # Templates are reused, so repeated calls must not leak values.
+        query = json.loads(protocol._generate_payload(DP_QUERY).payload)
+        assert "dps" not in query
+
+
+class FakeTransport(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def reply(seqno, cmd, payload=b""):
+    return TuyaMessage(seqno, cmd, 0, payload, 0, True, PREFIX_55AA_VALUE, None)
+
+
+async def test_pending_requests_matched_by_seqno_and_cmd():
+    dispatcher, received = make_dispatcher(3.3)
+    query = asyncio.create_task(dispatcher.wait_for(5, DP_QUERY))
+    beats = [asyncio.create_task(dispatcher.wait_for(n, HEART_BEAT)) for n in (6, 7)]
+    await asyncio.sleep(0)
+    assert set(dispatcher.pending) == {(5, DP_QUERY), (6, HEART_BEAT), (7, HEART_BEAT)}
+
+    # Out of order replies, a seqno 0 heartbeat answers the oldest heartbeat.
+    dispatcher._dispatch(reply(7, HEART_BEAT))
+    dispatcher._dispatch(reply(0, HEART_BEAT))
+    dispatcher._dispatch(reply(5, DP_QUERY, b"{}"))
+    assert (await beats[1]).seqno == 7
+    assert (await beats[0]).seqno == 0
+    assert (await query).payload == b"{}"
+    assert not dispatcher.pending and not received
+
+    # Timed out and cancelled waits leave nothing behind.
+    try:
+        await dispatcher.wait_for(8, HEART_BEAT, timeout=0.01)
+    except TimeoutError:
+        pass
+    task = asyncio.create_task(dispatcher.wait_for(9, HEART_BEAT))
+    await asyncio.sleep(0)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert not dispatcher.pending
+
+    # Aborting resolves every waiter with None.
+    waiters = [asyncio.create_task(dispatcher.wait_for(n, HEART_BEAT)) for n in (1, 2)]
+    await asyncio.sleep(0)
+    dispatcher.abort()
+    assert await asyncio.gather(*waiters) == [None, None]
+
+
+async def test_exchange_pipelined():
+    protocol = TuyaProtocol(DEV_ID, LOCAL_KEY.decode(), 3.3, False, EmptyListener())
+    transport = FakeTransport()
+    protocol.connection_made(transport)
+
+    tasks = [asyncio.create_task(protocol.heartbeat()) for _ in range(3)]
+    while len(transport.written) < 3:
+        await asyncio.sleep(0.01)
+    seqnos = [parse_header(data).seqno for data in transport.written]
+    assert len(protocol.dispatcher.pending) == 3
+
+    for seqno in reversed(seqnos):
+        protocol.dispatcher._dispatch(reply(seqno, HEART_BEAT))
+    assert await asyncio.gather(*tasks) == [None, None, None]
+    assert not protocol.dispatcher.pending